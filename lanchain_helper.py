@@ -1,14 +1,26 @@
 import os
+import json
+import time
+import hashlib
+import pickle
+import tempfile
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+import numpy as np
+import faiss
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from msal import ConfidentialClientApplication
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
 import streamlit as st
 from io import BytesIO
-from docx import Document as DocxDocument
-import PyPDF2
 
 # Microsoft App Credentials
 CLIENT_ID = st.secrets["CLIENT_ID"]
@@ -22,130 +34,426 @@ SHAREPOINT_HOST = st.secrets["SHAREPOINT_HOST"]
 SITE_NAME = st.secrets["SITE_NAME"]
 DOC_LIB_PATH = st.secrets["DOC_LIB_PATH"]
 
+# Microsoft Graph
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+# Retry throttling and transient server errors with exponential backoff
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.3
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 30.0
+
+# Shared session so MSAL login calls reuse TCP+TLS connections
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=None,
+    ),
+))
+
+# Access token reused until shortly before it expires
+_token_cache = {"value": None, "exp": 0}
+
+# Graph and file downloads share one HTTP/2 client per fetch
+HTTP_LIMITS = httpx.Limits(max_connections=64)
+HTTP_TIMEOUT = httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+# File downloads
+SUPPORTED_EXTENSIONS = (".txt", ".docx", ".pdf")
+DOWNLOAD_CONCURRENCY = 32
+
 # Embeddings
 EMBEDDINGS_MODEL = "sentence-transformers/all-mpnet-base-v2"
-embeddings = HuggingFaceEmbeddings(model_name=EMBEDDINGS_MODEL)
+INDEX_BATCH_SIZE = 128
+QUERY_CACHE_SIZE = 512
+
+# Vector index; embeddings are unit length, so inner product is cosine similarity
+VECTOR_INDEX_PATH = "./vector_index"
+FAISS_INDEX_PATH = os.path.join(VECTOR_INDEX_PATH, "index.faiss")
+DOCSTORE_PATH = os.path.join(VECTOR_INDEX_PATH, "index.pkl")
+SOURCE_FULL_PATH = os.path.join(VECTOR_INDEX_PATH, "source_full.pkl")
+MANIFEST_PATH = os.path.join(VECTOR_INDEX_PATH, "manifest.json")
+DISTANCE_STRATEGY = DistanceStrategy.MAX_INNER_PRODUCT
+
+# HNSW graph parameters for approximate nearest-neighbour search; vectors are
+# stored as int8 codes, a quarter of the float32 footprint
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+
+@st.cache_resource
+def get_embeddings():
+    # torch and the model weights load on first use, not at import
+    import torch
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDINGS_MODEL,
+        model_kwargs={"device": device, "model_kwargs": {"torch_dtype": dtype}},
+        encode_kwargs={"batch_size": 64, "normalize_embeddings": True},
+    )
 
 
-def authenticate():
-    app = ConfidentialClientApplication(
+@functools.lru_cache(maxsize=1)
+def _get_msal_app():
+    return ConfidentialClientApplication(
         client_id=CLIENT_ID,
         client_credential=CLIENT_SECRET,
         authority=AUTHORITY,
+        http_client=_session,
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
     )
-    result = app.acquire_token_for_client(scopes=SCOPES)
+
+
+def authenticate():
+    if _token_cache["value"] and time.time() < _token_cache["exp"] - 60:
+        return _token_cache["value"]
+
+    result = _get_msal_app().acquire_token_for_client(scopes=SCOPES)
     if "access_token" not in result:
         raise Exception(f"Authentication failed: {result.get('error_description')}")
+
+    _token_cache["value"] = result["access_token"]
+    _token_cache["exp"] = time.time() + result.get("expires_in", 0)
     return result["access_token"]
 
 
 def extract_text_from_docx(content: bytes) -> str:
+    from docx import Document as DocxDocument
+
     doc = DocxDocument(BytesIO(content))
     return "\n".join([p.text for p in doc.paragraphs])
 
 
 def extract_text_from_pdf(content: bytes) -> str:
-    reader = PyPDF2.PdfReader(BytesIO(content))
-    return "\n".join([page.extract_text() or "" for page in reader.pages])
-
+    import pypdfium2 as pdfium
 
-def fetch_txt_files_from_sharepoint():
+    pdf = pdfium.PdfDocument(content)
+    try:
+        # PDFium breaks lines with CRLF; normalize so PDFs split like .txt/.docx
+        return "\n".join([page.get_textpage().get_text_range().replace("\r\n", "\n") for page in pdf])
+    finally:
+        pdf.close()
+
+
+def extract_text(name: str, content: bytes) -> str:
+    if name.endswith(".docx"):
+        return extract_text_from_docx(content)
+    if name.endswith(".pdf"):
+        return extract_text_from_pdf(content)
+    return content.decode("utf-8")
+
+
+async def _send(client, method, url, **kwargs):
+    # Same policy as the requests session's Retry, honouring Retry-After on 429s
+    for attempt in range(HTTP_RETRIES + 1):
+        delay = HTTP_BACKOFF * 2 ** attempt
+        try:
+            resp = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == HTTP_RETRIES:
+                raise
+        else:
+            if resp.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                return resp
+            if resp.headers.get("Retry-After", "").isdigit():
+                delay = int(resp.headers["Retry-After"])
+        await asyncio.sleep(delay)
+
+
+async def _download_all(items, client):
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor() as pool:
+        async def download(item):
+            async with semaphore:
+                resp = await _send(client, "GET", item["@microsoft.graph.downloadUrl"])
+            resp.raise_for_status()
+            if item["name"].endswith(".txt"):
+                return resp.content.decode("utf-8")
+            # docx/pdf parsing is CPU-bound, keep it off the event loop
+            return await loop.run_in_executor(pool, extract_text, item["name"], resp.content)
+
+        return await asyncio.gather(*(download(item) for item in items))
+
+
+async def graph_get(path, token, client):
+    resp = await _send(client, "GET", f"{GRAPH_URL}{path}", headers={"Authorization": f"Bearer {token}"})
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def fetch_txt_files_from_sharepoint(manifest=None):
+    # Returns the eTag of every supported file, plus Documents only for files
+    # whose eTag differs from the manifest of the last indexing run
+    manifest = manifest or {}
     token = authenticate()
-    headers = {"Authorization": f"Bearer {token}"}
 
     try:
-        site_url = f"https://graph.microsoft.com/v1.0/sites/{SHAREPOINT_HOST}:/sites/{SITE_NAME}"
-        site_id = requests.get(site_url, headers=headers).json()["id"]
-
-        drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-        drive_id = next((d["id"] for d in requests.get(drives_url, headers=headers).json()["value"] if d["name"] == "Documents"), None)
-
-        encoded_path = DOC_LIB_PATH.replace(" ", "%20")
-        files_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root:/{encoded_path}:/children"
-        files = requests.get(files_url, headers=headers).json().get("value", [])
+        async with httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT) as client:
+            # Address drives by site path so no separate site-id lookup is needed
+            drives = (await graph_get(f"/sites/{SHAREPOINT_HOST}:/sites/{SITE_NAME}:/drives", token, client))["value"]
+            drive_id = next((d["id"] for d in drives if d["name"] == "Documents"), None)
+
+            encoded_path = DOC_LIB_PATH.replace(" ", "%20")
+            select = "name,eTag,lastModifiedDateTime,@microsoft.graph.downloadUrl"
+            files = (await graph_get(
+                f"/drives/{drive_id}/root:/{encoded_path}:/children?$select={select}", token, client,
+            )).get("value", [])
+
+            items = [item for item in files if item["name"].endswith(SUPPORTED_EXTENSIONS)]
+            etags = {item["name"]: item["eTag"] for item in items}
+            changed = [item for item in items if manifest.get(item["name"]) != item["eTag"]]
+            texts = await _download_all(changed, client)
 
         docs = []
-        for item in files:
-            name = item["name"]
-            if name.endswith((".txt", ".docx", ".pdf")):
-                file_resp = requests.get(item["@microsoft.graph.downloadUrl"])
-                file_resp.raise_for_status()
-                content = file_resp.content
-
-                if name.endswith(".txt"):
-                    text = content.decode("utf-8")
-                elif name.endswith(".docx"):
-                    text = extract_text_from_docx(content)
-                elif name.endswith(".pdf"):
-                    text = extract_text_from_pdf(content)
-                else:
-                    continue
-
-                docs.append(Document(page_content=text, metadata={
-                    "source": name,
-                    "full_content": text
-                }))
-
-        return docs
-
-    except Exception:
-        return []
+        for item, text in zip(changed, texts):
+            docs.append(Document(page_content=text, metadata={"source": item["name"]}))
 
+        return etags, docs
 
-def index_documents():
-    documents = fetch_txt_files_from_sharepoint()
-    if not documents:
+    except Exception:
+        return {}, []
+
+
+def build_hnsw_index(vectors, sq_trained=None):
+    index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if sq_trained is None:
+        index.train(vectors)
+    else:
+        # Vectors decoded from the old index re-encode to the same codes only under
+        # the same ranges; retraining on them would narrow the ranges on every run.
+        # New vectors outside the trained ranges are clamped, so a full re-index
+        # is what refits the quantizer to the current corpus.
+        storage = faiss.downcast_index(index.storage)
+        faiss.copy_array_to_vector(sq_trained, storage.sq.trained)
+        storage.is_trained = True
+        index.is_trained = True
+    index.add(vectors)
+    return index
+
+
+def sq_trained_params(index):
+    # Trained int8 ranges of an existing index, or None if it isn't quantized
+    storage = faiss.downcast_index(index.storage)
+    if not isinstance(storage, faiss.IndexScalarQuantizer):
+        return None
+    # Copied out so it outlives the index it came from
+    return faiss.vector_to_array(storage.sq.trained)
+
+
+def embed_texts(texts):
+    import torch
+
+    # Boilerplate repeated across files (headers, footers, templates) is embedded once
+    unique = {}
+    order = []
+    for text in texts:
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        unique.setdefault(digest, text)
+        order.append(digest)
+
+    # One encode call over every unique chunk; sentence-transformers sorts by
+    # length so each batch is padded only to its own longest text
+    with torch.inference_mode():
+        vectors = get_embeddings().client.encode(
+            list(unique.values()),
+            batch_size=INDEX_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        ).astype("float32")
+
+    vec_by_hash = dict(zip(unique, vectors))
+    return np.stack([vec_by_hash[digest] for digest in order])
+
+
+def chunk_ids(chunks):
+    # Deterministic ids let a changed or deleted file's chunks be found again
+    counts = {}
+    ids = []
+    for chunk in chunks:
+        source = chunk.metadata["source"]
+        ids.append(f"{hashlib.sha1(source.encode()).hexdigest()}_{counts.get(source, 0)}")
+        counts[source] = counts.get(source, 0) + 1
+    return ids
+
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def save_vectorstore(vectorstore, source_to_full, manifest):
+    # Files are written to a scratch dir and renamed into place, so an index
+    # that is still memory-mapped by a running query is never truncated
+    os.makedirs(VECTOR_INDEX_PATH, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=VECTOR_INDEX_PATH) as tmp_dir:
+        vectorstore.save_local(tmp_dir)
+        with open(os.path.join(tmp_dir, os.path.basename(SOURCE_FULL_PATH)), "wb") as f:
+            pickle.dump(source_to_full, f)
+        with open(os.path.join(tmp_dir, os.path.basename(MANIFEST_PATH)), "w") as f:
+            json.dump(manifest, f)
+        # The manifest goes last so it never claims files the index doesn't hold
+        names = sorted(os.listdir(tmp_dir), key=lambda name: name == os.path.basename(MANIFEST_PATH))
+        for name in names:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(VECTOR_INDEX_PATH, name))
+
+
+def index_documents(full=False):
+    vectorstore = None
+    sq_trained = None
+    manifest = {} if full else load_manifest()
+    if manifest:
+        try:
+            vectorstore = load_vectorstore()
+            with open(SOURCE_FULL_PATH, "rb") as f:
+                source_to_full = pickle.load(f)
+        except Exception:
+            vectorstore, manifest = None, {}
+
+    etags, documents = asyncio.run(fetch_txt_files_from_sharepoint(manifest))
+    if not etags:
         raise Exception("No supported documents found to index.")
 
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    source_to_full = {doc.metadata["source"]: doc.metadata["full_content"] for doc in documents}
     chunks = text_splitter.split_documents(documents)
+    ids = chunk_ids(chunks)
+    texts = [chunk.page_content for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    text_embeddings = list(zip(texts, embed_texts(texts))) if chunks else []
+
+    if vectorstore is None:
+        if not chunks:
+            raise Exception("No supported documents found to index.")
+        # Full texts are stored once per source rather than copied into every chunk
+        source_to_full = {doc.metadata["source"]: doc.page_content for doc in documents}
+        vectorstore = FAISS.from_embeddings(
+            text_embeddings, get_embeddings(), metadatas=metadatas, ids=ids,
+            distance_strategy=DISTANCE_STRATEGY,
+        )
+    else:
+        stale = {source for source in manifest if manifest[source] != etags.get(source)}
+        if not stale and not documents:
+            return
+
+        # HNSW can't remove vectors, so edit a flat copy and rebuild the graph afterwards
+        sq_trained = sq_trained_params(vectorstore.index)
+        flat = faiss.IndexFlatIP(vectorstore.index.d)
+        flat.add(vectorstore.index.reconstruct_n(0, vectorstore.index.ntotal))
+        vectorstore.index = flat
+
+        stale_prefixes = {hashlib.sha1(source.encode()).hexdigest() for source in stale}
+        stale_ids = [
+            doc_id for doc_id in vectorstore.index_to_docstore_id.values()
+            if doc_id.rsplit("_", 1)[0] in stale_prefixes
+        ]
+        if stale_ids:
+            vectorstore.delete(ids=stale_ids)
+        if chunks:
+            vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+        for source in stale:
+            source_to_full.pop(source, None)
+        source_to_full.update({doc.metadata["source"]: doc.page_content for doc in documents})
+
+    # Files whose text extracts to nothing (e.g. scanned PDFs) leave no vectors
+    if vectorstore.index.ntotal == 0:
+        raise Exception("No supported documents found to index.")
+    vectorstore.index = build_hnsw_index(vectorstore.index.reconstruct_n(0, vectorstore.index.ntotal), sq_trained)
+    save_vectorstore(vectorstore, source_to_full, etags)
+    get_vectorstore.clear()
+    get_source_full.clear()
+
+
+def load_vectorstore():
+    # Vectors stay on disk and are paged in on demand instead of copied into RAM
+    index = faiss.read_index(FAISS_INDEX_PATH, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    with open(DOCSTORE_PATH, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vectorstore = FAISS(
+        get_embeddings(), index, docstore, index_to_docstore_id,
+        distance_strategy=DISTANCE_STRATEGY,
+    )
+    if not isinstance(vectorstore.index, faiss.IndexHNSW) or vectorstore.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        raise ValueError("Vector index uses an outdated layout; it must be rebuilt.")
+    if not os.path.exists(SOURCE_FULL_PATH):
+        raise ValueError("Vector index has no full-text map; it must be rebuilt.")
+    vectorstore.index.hnsw.efSearch = HNSW_EF_SEARCH
+    return vectorstore
 
-    for chunk in chunks:
-        source = chunk.metadata.get("source")
-        chunk.metadata["full_content"] = source_to_full.get(source, "")
 
-    vectorstore = FAISS.from_documents(chunks, embeddings)
-    vectorstore.save_local("./vector_index")
+@st.cache_resource
+def get_source_full():
+    with open(SOURCE_FULL_PATH, "rb") as f:
+        return pickle.load(f)
 
 
-def get_similar_answer_from_documents(query: str, score_threshold=0.6):
-    if not os.path.exists("./vector_index"):
-        index_documents()
+@st.cache_resource
+def get_vectorstore():
+    if not os.path.exists(VECTOR_INDEX_PATH):
+        index_documents(full=True)
 
     try:
-        vectorstore = FAISS.load_local(
-            "./vector_index", embeddings, allow_dangerous_deserialization=True
-        )
+        return load_vectorstore()
     except Exception:
-        index_documents()
-        vectorstore = FAISS.load_local(
-            "./vector_index", embeddings, allow_dangerous_deserialization=True
-        )
+        index_documents(full=True)
+        return load_vectorstore()
 
-    docs_with_scores = vectorstore.similarity_search_with_score(query, k=10)
 
-    if not docs_with_scores:
-        return "Good Question, We dont have enough information to answer that.", None
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def embed_query(query: str):
+    # Repeated questions and Streamlit reruns skip tokenization and the forward pass
+    return tuple(get_embeddings().embed_query(query))
 
-    # Sort by score (ascending — most relevant first)
-    docs_with_scores.sort(key=lambda x: x[1])
-    best_doc, best_score = docs_with_scores[0]
 
-    if best_score > score_threshold:
-        return "❌ No relevant results found based on the threshold.", None
+def search_within_threshold(vectorstore, query_vector, score_threshold):
+    # range_search returns only vectors whose similarity clears the threshold,
+    # in one FAISS call with no top-k heap
+    lims, scores, positions = vectorstore.index.range_search(query_vector[None, :], score_threshold)
+    if lims[1] == 0:
+        return None
 
-    # Get full content of the best-matched document
-    full_content = best_doc.metadata.get("full_content", "")
-    if not full_content:
-        # Fallback to combining all chunks from the same source
-        source = best_doc.metadata.get("source")
-        related_chunks = [
-            doc.page_content for doc, score in docs_with_scores
-            if doc.metadata.get("source") == source
-        ]
-        full_content = "\n\n".join(related_chunks)
+    best = int(np.argmax(scores))
+    doc_id = vectorstore.index_to_docstore_id[int(positions[best])]
+    doc = vectorstore.docstore.search(doc_id)
+    if not isinstance(doc, Document):
+        raise KeyError(doc_id)
+    return doc
 
-    return f"🔍 **Answer:**\n\n{full_content}", full_content
 
+def get_similar_answer_from_documents(query: str, score_threshold=0.7, vectorstore=None):
+    if vectorstore is None:
+        vectorstore = get_vectorstore()
 
+    if vectorstore.index.ntotal == 0:
+        return "Good Question, We dont have enough information to answer that.", None
+
+    query_vector = np.array(embed_query(query.strip().lower()), dtype="float32")
+    try:
+        best_doc = search_within_threshold(vectorstore, query_vector, score_threshold)
+    except (IndexError, KeyError):
+        # Index and docstore are out of sync; rebuild and retry once
+        index_documents(full=True)
+        vectorstore = get_vectorstore()
+        best_doc = search_within_threshold(vectorstore, query_vector, score_threshold)
+
+    if best_doc is None:
+        return "❌ No relevant results found based on the threshold.", None
+
+    # Get full content of the best-matched document, falling back to the chunk itself
+    full_content = get_source_full().get(best_doc.metadata.get("source")) or best_doc.page_content
+
+    return f"🔍 **Answer:**\n\n{full_content}", full_content
@@ -1,8 +1,11 @@
 import streamlit as st
 import re
-from lanchain_helper import get_similar_answer_from_documents, fetch_txt_files_from_sharepoint, index_documents
+from lanchain_helper import get_similar_answer_from_documents, fetch_txt_files_from_sharepoint, index_documents, get_vectorstore
 import os
 
+# Questions shorter than three characters are rejected
+_VALID_Q = re.compile(r'^[\s\S]{3,}$')
+
 # Detect if running in Streamlit Cloud
 IS_CLOUD = st.secrets.get("RUN_ENV", "local") == "cloud"
 
@@ -97,13 +100,13 @@ if question:
     if not (st.session_state.messages and st.session_state.messages[-1]["role"] == "user" and st.session_state.messages[-1]["content"] == question):
         st.session_state.messages.append({"role": "user", "content": question})
 
-    if not re.match(r'^[\s\S]{3,}$', question):
+    if not _VALID_Q.match(question):
         response = "I couldn't understand that. Please ask a clear question."
         full_doc = None
     else:
         with st.spinner("🔍 Fetching answer..."):
             try:
-                response, full_doc = get_similar_answer_from_documents(question, score_threshold=1.0)
+                response, full_doc = get_similar_answer_from_documents(question, score_threshold=0.5, vectorstore=get_vectorstore())
                 if not response or response.strip() == "":
                     response = "I'm not sure how to help with that. Please ask something related to Oracle documents."
                     full_doc = None